@@ -0,0 +1,112 @@
+/*
+ * Fused squared-L2 diff + threshold kernel for interleaved 8-bit RGB images.
+ *
+ * out[i] = 0xFF if dr^2 + dg^2 + db^2 > thr_sq else 0, for n pixels.
+ * The AVX2 path handles 16 pixels (48 bytes) per iteration and is picked at
+ * runtime, so the module still works on CPUs without AVX2.
+ */
+#ifndef SHOTDIFF_SIMD_H
+#define SHOTDIFF_SIMD_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+static void shotdiff_diff_mask_scalar(const uint8_t *a, const uint8_t *b, ptrdiff_t n,
+                                      int32_t thr_sq, uint8_t *out)
+{
+    for (ptrdiff_t i = 0; i < n; i++) {
+        int32_t dr = (int32_t)a[3 * i] - b[3 * i];
+        int32_t dg = (int32_t)a[3 * i + 1] - b[3 * i + 1];
+        int32_t db = (int32_t)a[3 * i + 2] - b[3 * i + 2];
+        out[i] = dr * dr + dg * dg + db * db > thr_sq ? 0xFF : 0;
+    }
+}
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#define SHOTDIFF_HAVE_AVX2 1
+
+/* Shuffle mask gathering channel c of 16 pixels from the 16-byte block k. */
+__attribute__((target("avx2")))
+static __m128i shotdiff_plane_mask(int c, int k)
+{
+    int8_t idx[16];
+    for (int i = 0; i < 16; i++) {
+        int src = 3 * i + c - 16 * k;
+        idx[i] = (src >= 0 && src < 16) ? (int8_t)src : (int8_t)0x80;
+    }
+    return _mm_loadu_si128((const __m128i *)idx);
+}
+
+__attribute__((target("avx2")))
+static void shotdiff_diff_mask_avx2(const uint8_t *a, const uint8_t *b, ptrdiff_t n,
+                                    int32_t thr_sq, uint8_t *out)
+{
+    __m128i shuf[3][3];
+    for (int c = 0; c < 3; c++)
+        for (int k = 0; k < 3; k++)
+            shuf[c][k] = shotdiff_plane_mask(c, k);
+
+    const __m256i thr = _mm256_set1_epi32(thr_sq);
+    const __m256i zero = _mm256_setzero_si256();
+    ptrdiff_t i = 0;
+
+    for (; i + 16 <= n; i += 16) {
+        const uint8_t *pa = a + 3 * i;
+        const uint8_t *pb = b + 3 * i;
+
+        /* Saturating absdiff on the interleaved bytes */
+        __m128i d[3];
+        for (int k = 0; k < 3; k++) {
+            __m128i va = _mm_loadu_si128((const __m128i *)(pa + 16 * k));
+            __m128i vb = _mm_loadu_si128((const __m128i *)(pb + 16 * k));
+            d[k] = _mm_or_si128(_mm_subs_epu8(va, vb), _mm_subs_epu8(vb, va));
+        }
+
+        /* Deinterleave into per-channel planes of 16 pixels */
+        __m128i plane[3];
+        for (int c = 0; c < 3; c++)
+            plane[c] = _mm_or_si128(_mm_or_si128(_mm_shuffle_epi8(d[0], shuf[c][0]),
+                                                 _mm_shuffle_epi8(d[1], shuf[c][1])),
+                                    _mm_shuffle_epi8(d[2], shuf[c][2]));
+
+        /* Zero-extend to i16 and square-accumulate pairs with VPMADDWD */
+        __m256i r = _mm256_cvtepu8_epi16(plane[0]);
+        __m256i g = _mm256_cvtepu8_epi16(plane[1]);
+        __m256i bl = _mm256_cvtepu8_epi16(plane[2]);
+
+        __m256i rg_lo = _mm256_unpacklo_epi16(r, g);
+        __m256i rg_hi = _mm256_unpackhi_epi16(r, g);
+        __m256i b_lo = _mm256_unpacklo_epi16(bl, zero);
+        __m256i b_hi = _mm256_unpackhi_epi16(bl, zero);
+
+        __m256i sum_lo = _mm256_add_epi32(_mm256_madd_epi16(rg_lo, rg_lo),
+                                          _mm256_madd_epi16(b_lo, b_lo));
+        __m256i sum_hi = _mm256_add_epi32(_mm256_madd_epi16(rg_hi, rg_hi),
+                                          _mm256_madd_epi16(b_hi, b_hi));
+
+        /* Compare and pack back down; the per-lane unpack and pack cancel out */
+        __m256i m16 = _mm256_packs_epi32(_mm256_cmpgt_epi32(sum_lo, thr),
+                                         _mm256_cmpgt_epi32(sum_hi, thr));
+        __m128i m8 = _mm_packs_epi16(_mm256_castsi256_si128(m16),
+                                     _mm256_extracti128_si256(m16, 1));
+        _mm_storeu_si128((__m128i *)(out + i), m8);
+    }
+
+    shotdiff_diff_mask_scalar(a + 3 * i, b + 3 * i, n - i, thr_sq, out + i);
+}
+#endif
+
+static void shotdiff_diff_mask_u8(const uint8_t *a, const uint8_t *b, ptrdiff_t n,
+                                  int32_t thr_sq, uint8_t *out)
+{
+#ifdef SHOTDIFF_HAVE_AVX2
+    if (__builtin_cpu_supports("avx2")) {
+        shotdiff_diff_mask_avx2(a, b, n, thr_sq, out);
+        return;
+    }
+#endif
+    shotdiff_diff_mask_scalar(a, b, n, thr_sq, out);
+}
+
+#endif /* SHOTDIFF_SIMD_H */
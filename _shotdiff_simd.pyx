@@ -0,0 +1,33 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# distutils: extra_compile_args = -O3
+"""
+Optional compiled diff kernel for ShotDiff.
+
+Build in place with:
+
+    cythonize -i _shotdiff_simd.pyx
+
+shot_diff.py falls back to Numba or OpenCV when this module is not built.
+"""
+
+from libc.stdint cimport uint8_t, int32_t
+
+cdef extern from "_shotdiff_simd.h" nogil:
+    void shotdiff_diff_mask_u8(const uint8_t *a, const uint8_t *b, Py_ssize_t n,
+                               int32_t thr_sq, uint8_t *out)
+
+
+def diff_mask_u8(const uint8_t[:, :, ::1] a, const uint8_t[:, :, ::1] b, int thr_sq,
+                 uint8_t[:, ::1] out):
+    """Write 255 into out wherever the squared RGB distance exceeds thr_sq."""
+    cdef Py_ssize_t n = a.shape[0] * a.shape[1]
+
+    if a.shape[0] != b.shape[0] or a.shape[1] != b.shape[1] or a.shape[2] != 3 or b.shape[2] != 3:
+        raise ValueError("Inputs must be same-shaped 3-channel images")
+    if out.shape[0] != a.shape[0] or out.shape[1] != a.shape[1]:
+        raise ValueError("Output must match the input height and width")
+    if n == 0:
+        return
+
+    with nogil:
+        shotdiff_diff_mask_u8(&a[0, 0, 0], &b[0, 0, 0], n, thr_sq, &out[0, 0])
@@ -5,22 +5,43 @@ Usage: python server.py
 Access: https://shot-diff.kadoa.dev/?i1=URL_TO_IMAGE1&i2=URL_TO_IMAGE2
 """
 
+import hashlib
+import io
 import os
+import shutil
+import struct
 import tempfile
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, send_file, jsonify
-from shot_diff import ShotDiff
+from shot_diff import ShotDiff, blank_overlay
 
 app = Flask(__name__)
 
 # Configuration
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 TIMEOUT = 30  # seconds
+CHUNK_SIZE = 64 * 1024  # download copy buffer
+MAX_PIXELS = 50_000_000  # reject larger images before decoding
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
 
+# Shared session so TCP/TLS connections are reused across downloads
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'shot-diff/1.0'})
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                       max_retries=Retry(total=2, backoff_factor=0.1))
+_SESSION.mount('http://', _adapter)
+_SESSION.mount('https://', _adapter)
+
+# Shared instance so scratch buffers are reused across requests
+shot_diff = ShotDiff()
+
 def is_valid_image_url(url):
     """Basic URL validation."""
     try:
@@ -29,34 +50,99 @@ def is_valid_image_url(url):
     except:
         return False
 
+class SizeLimitedWriter:
+    """File wrapper that hashes written bytes and raises once more than max_size are written."""
+
+    def __init__(self, f, max_size):
+        self.f = f
+        self.max_size = max_size
+        self.written = 0
+        self.hash = hashlib.blake2b()
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > self.max_size:
+            raise ValueError("File too large during download")
+        self.hash.update(data)
+        return self.f.write(data)
+
+# JPEG start-of-frame markers (all except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def read_image_size(filepath):
+    """Read (width, height) from a PNG or JPEG header, or None if unknown."""
+    with open(filepath, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:2] != b'\xff\xd8':
+            return None
+        
+        # Walk JPEG segments until a start-of-frame marker
+        f.seek(2)
+        while True:
+            if f.read(1) != b'\xff':
+                return None
+            code = f.read(1)
+            while code == b'\xff':
+                code = f.read(1)
+            if not code:
+                return None
+            code = code[0]
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue  # standalone markers have no length
+            segment = f.read(2)
+            if len(segment) < 2:
+                return None
+            length = struct.unpack('>H', segment)[0]
+            if code in JPEG_SOF_MARKERS:
+                frame = f.read(5)
+                if len(frame) < 5:
+                    return None
+                height, width = struct.unpack('>HH', frame[1:5])
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+@lru_cache(maxsize=8)
+def blank_overlay_png(width, height):
+    """Encoded fully transparent overlay, cached per size."""
+    buf = io.BytesIO()
+    blank_overlay(height, width).save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()
+
 def download_image(url, filepath):
-    """Download image from URL to filepath."""
-    headers = {
-        'User-Agent': 'shot-diff/1.0'
-    }
+    """
+    Download image from URL to filepath.
     
-    response = requests.get(url, headers=headers, timeout=TIMEOUT, stream=True)
-    response.raise_for_status()
-    
-    # Check content length
-    content_length = response.headers.get('content-length')
-    if content_length and int(content_length) > MAX_FILE_SIZE:
-        raise ValueError(f"File too large: {content_length} bytes")
-    
-    # Check content type
-    content_type = response.headers.get('content-type', '').lower()
-    if not any(ct in content_type for ct in ['image/jpeg', 'image/png', 'image/webp']):
-        raise ValueError(f"Invalid content type: {content_type}")
-    
-    # Download with size limit
-    with open(filepath, 'wb') as f:
-        downloaded = 0
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                downloaded += len(chunk)
-                if downloaded > MAX_FILE_SIZE:
-                    raise ValueError("File too large during download")
-                f.write(chunk)
+    Returns:
+        tuple: Content digest and (width, height) from the header, or None if unknown
+    """
+    with _SESSION.get(url, timeout=TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        
+        # Check content length
+        content_length = response.headers.get('content-length')
+        if content_length and int(content_length) > MAX_FILE_SIZE:
+            raise ValueError(f"File too large: {content_length} bytes")
+        
+        # Check content type
+        content_type = response.headers.get('content-type', '').lower()
+        if not any(ct in content_type for ct in ['image/jpeg', 'image/png', 'image/webp']):
+            raise ValueError(f"Invalid content type: {content_type}")
+        
+        # Download with size limit
+        response.raw.decode_content = True
+        with open(filepath, 'wb') as f:
+            writer = SizeLimitedWriter(f, MAX_FILE_SIZE)
+            shutil.copyfileobj(response.raw, writer, CHUNK_SIZE)
+        
+        # Check dimensions before anything decodes the image
+        size = read_image_size(filepath)
+        if size and size[0] * size[1] > MAX_PIXELS:
+            raise ValueError(f"Image too large: {size[0]}x{size[1]} pixels")
+        
+        return writer.hash.digest(), size
 
 @app.route('/')
 def compare_images():
@@ -82,22 +168,31 @@ def compare_images():
             img1_path = temp_dir / f"img1_{session_id}.png"
             img2_path = temp_dir / f"img2_{session_id}.png"
             
-            # Download images
-            download_image(img1_url, img1_path)
-            download_image(img2_url, img2_path)
+            # Download images concurrently
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                f1 = executor.submit(download_image, img1_url, img1_path)
+                f2 = executor.submit(download_image, img2_url, img2_path)
+                digest1, size1 = f1.result()
+                digest2, size2 = f2.result()
+            
+            # Byte-identical files need no decoding or diffing
+            if digest1 == digest2 and size1:
+                return send_file(io.BytesIO(blank_overlay_png(*size1)), mimetype='image/png')
             
             # Run shot diff
-            shot_diff = ShotDiff()
-            results = shot_diff.compare_images(str(img1_path), str(img2_path), str(temp_dir))
+            results = shot_diff.compare_images(str(img1_path), str(img2_path), str(temp_dir),
+                                               in_memory=True, write_json=False)
             
-            overlay_path = results['overlay_path']
+            # Encode the overlay in memory with fast compression
+            buf = io.BytesIO()
+            results['overlay'].save(buf, format='PNG', compress_level=1)
+            buf.seek(0)
             
             # Return the overlay image
-            return send_file(overlay_path, mimetype='image/png')
+            return send_file(buf, mimetype='image/png')
             
         finally:
             # Cleanup temporary files
-            import shutil
             shutil.rmtree(temp_dir, ignore_errors=True)
             
     except requests.exceptions.RequestException as e:
@@ -8,107 +8,265 @@ into bounding rectangles, and outputs transparent overlays.
 
 import argparse
 import json
+import threading
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image
 import cv2
 from pathlib import Path
 from typing import Tuple, List
 
+# Rows per band when diffing without numba; keeps a band's intermediates in L2
+TILE_ROWS = 128
+# Number of distinct image widths to keep scratch buffers for
+MAX_BUFFER_WIDTHS = 4
+
+# Contour detection runs on a mask downsampled by this factor for large images
+DOWNSAMPLE_FACTOR = 2
+DOWNSAMPLE_MIN_SIZE = 1500
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; fall back to plain NumPy
+    njit = None
+
+try:
+    from _shotdiff_simd import diff_mask_u8
+except ImportError:  # compiled kernel is optional; see _shotdiff_simd.pyx
+    diff_mask_u8 = None
+
+
+def squared_threshold(distance: float) -> int:
+    """
+    Translate an RGB distance threshold into the squared value used by ShotDiff.
+    
+    Args:
+        distance: Euclidean RGB distance between two pixels (0-441)
+    """
+    return int(round(distance * distance))
+
+
+def blank_overlay(height: int, width: int) -> Image.Image:
+    """Create a fully transparent overlay."""
+    return Image.new('RGBA', (width, height), (0, 0, 0, 0))
+
+
+def cuda_available() -> bool:
+    """Check whether OpenCV was built with CUDA and a GPU is present."""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _diff_mask(a, b, threshold_sq, out):
+        """Write 255 into out wherever the squared RGB distance exceeds threshold_sq."""
+        h, w = out.shape
+        for y in prange(h):
+            for x in range(w):
+                dr = np.int32(a[y, x, 0]) - np.int32(b[y, x, 0])
+                dg = np.int32(a[y, x, 1]) - np.int32(b[y, x, 1])
+                db = np.int32(a[y, x, 2]) - np.int32(b[y, x, 2])
+                out[y, x] = 255 if dr * dr + dg * dg + db * db > threshold_sq else 0
+
 
 class ShotDiff:
-    def __init__(self, diff_threshold: int = 50, min_area: int = 100, padding: int = 5):
+    def __init__(self, diff_threshold: int = 2500, min_area: int = 100, padding: int = 5,
+                 use_cuda: bool = False):
         """
         Initialize the ShotDiff utility.
         
         Args:
-            diff_threshold: Pixel difference threshold (0-255)
-            min_area: Minimum rectangle area to keep (ignore noise)  
-            padding: Expand rectangles by this many pixels
+            diff_threshold: Squared RGB distance threshold (0-195075). Unlike the
+                former normalized 0-255 value it does not depend on the largest
+                difference in the image; use squared_threshold() to convert a
+                plain distance.
+            min_area: Minimum number of changed pixels in a region to keep it (ignore noise)
+            padding: Expand rectangles by this many pixels; regions closer than
+                twice the padding are merged
+            use_cuda: Compute the diff mask on the GPU when one is available; only
+                pays off for very large images since both inputs cross PCIe
         """
         self.diff_threshold = diff_threshold
         self.min_area = min_area
         self.padding = padding
+        self.use_cuda = use_cuda and cuda_available()
+        
+        # Scratch buffers reused across calls, keyed by image width
+        self._buffers = {}
+        self._buffers_lock = threading.Lock()
     
     def load_images(self, img1_path: str, img2_path: str) -> Tuple[np.ndarray, np.ndarray]:
         """Load and preprocess two images for comparison."""
-        img1 = Image.open(img1_path).convert('RGB')
-        img2 = Image.open(img2_path).convert('RGB')
+        # Decode straight into arrays; channel order (BGR) doesn't matter for the diff.
+        # Ignore EXIF orientation like PIL did, so shapes match the file headers
+        img1 = cv2.imread(str(img1_path), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        img2 = cv2.imread(str(img2_path), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        
+        for img, path in ((img1, img1_path), (img2, img2_path)):
+            if img is None:
+                raise ValueError(f"Could not decode image: {path}")
         
         # Ensure same width, crop to same height if needed
-        if img1.size[0] != img2.size[0]:
-            raise ValueError(f"Images must have same width. Got {img1.size[0]} and {img2.size[0]}")
+        if img1.shape[1] != img2.shape[1]:
+            raise ValueError(f"Images must have same width. Got {img1.shape[1]} and {img2.shape[1]}")
         
         # Crop to minimum height if heights differ
-        if img1.size[1] != img2.size[1]:
-            min_height = min(img1.size[1], img2.size[1])
-            img1 = img1.crop((0, 0, img1.size[0], min_height))
-            img2 = img2.crop((0, 0, img2.size[0], min_height))
+        if img1.shape[0] != img2.shape[0]:
+            min_height = min(img1.shape[0], img2.shape[0])
+            img1 = img1[:min_height]
+            img2 = img2[:min_height]
         
-        return np.array(img1), np.array(img2)
+        return img1, img2
     
-    def generate_diff_map(self, img1: np.ndarray, img2: np.ndarray) -> np.ndarray:
-        """Generate grayscale difference map between two images."""
-        # Calculate per-pixel RGB differences
-        diff = np.abs(img1.astype(int) - img2.astype(int))
+    def _compute_mask(self, img1: np.ndarray, img2: np.ndarray) -> np.ndarray:
+        """Create binary mask of pixels whose squared RGB distance exceeds the threshold."""
+        if self.use_cuda:
+            return self._compute_mask_cuda(img1, img2)
         
-        # Convert to grayscale using L2 norm
-        diff_gray = np.sqrt(np.sum(diff ** 2, axis=2))
+        if diff_mask_u8 is not None:
+            mask = np.empty(img1.shape[:2], np.uint8)
+            diff_mask_u8(np.ascontiguousarray(img1), np.ascontiguousarray(img2), self.diff_threshold, mask)
+            return mask
         
-        # Normalize to 0-255
-        diff_normalized = (diff_gray / diff_gray.max() * 255).astype(np.uint8)
+        if njit is not None:
+            mask = np.empty(img1.shape[:2], np.uint8)
+            _diff_mask(img1, img2, self.diff_threshold, mask)
+            return mask
+        
+        # Process row bands so every intermediate stays cache-resident
+        height, width = img1.shape[:2]
+        mask = np.empty((height, width), np.uint8)
+        with self._buffers_lock:
+            buffers = self._band_buffers(width)
+            for y0 in range(0, height, TILE_ROWS):
+                y1 = min(y0 + TILE_ROWS, height)
+                rows = y1 - y0
+                
+                # Squared L2 norm per pixel in the narrowest exact dtypes:
+                # |u8 - u8| fits uint8, its square uint16, the 3-channel sum uint32
+                d = cv2.absdiff(img1[y0:y1], img2[y0:y1], buffers['diff'][:rows])
+                sq = cv2.multiply(d, d, buffers['sq'][:rows], dtype=cv2.CV_16U)
+                sq_sum = sq.sum(axis=2, dtype=np.uint32, out=buffers['sum'][:rows])
+                
+                band = mask[y0:y1]
+                np.greater(sq_sum, self.diff_threshold, out=band.view(np.bool_))
+                band *= 255
         
-        return diff_normalized
-    
-    def threshold_differences(self, diff_map: np.ndarray) -> np.ndarray:
-        """Apply threshold to create binary mask of significant differences."""
-        mask = (diff_map > self.diff_threshold).astype(np.uint8) * 255
         return mask
     
+    def _compute_mask_cuda(self, img1: np.ndarray, img2: np.ndarray) -> np.ndarray:
+        """Create the difference mask on the GPU."""
+        gpu1 = cv2.cuda_GpuMat()
+        gpu2 = cv2.cuda_GpuMat()
+        gpu1.upload(img1)
+        gpu2.upload(img2)
+        
+        # Squared L2 norm per pixel
+        d = cv2.cuda.absdiff(gpu1, gpu2).convertTo(cv2.CV_32FC3)
+        sq = cv2.cuda.multiply(d, d)
+        c0, c1, c2 = cv2.cuda.split(sq)
+        sq_sum = cv2.cuda.add(cv2.cuda.add(c0, c1), c2)
+        _, gpu_mask = cv2.cuda.threshold(sq_sum, self.diff_threshold, 255, cv2.THRESH_BINARY)
+        
+        # Labeling stays on the CPU; only the single-channel mask is downloaded
+        return gpu_mask.download().astype(np.uint8)
+    
+    def _band_buffers(self, width: int) -> dict:
+        """Return reusable scratch buffers for one row band of the given width."""
+        buffers = self._buffers.get(width)
+        if buffers is None:
+            if len(self._buffers) >= MAX_BUFFER_WIDTHS:
+                self._buffers.clear()
+            buffers = self._buffers[width] = {
+                'diff': np.empty((TILE_ROWS, width, 3), np.uint8),
+                'sq': np.empty((TILE_ROWS, width, 3), np.uint16),
+                'sum': np.empty((TILE_ROWS, width), np.uint32),
+            }
+        return buffers
+    
     def detect_contours(self, mask: np.ndarray) -> List[Tuple[int, int, int, int]]:
-        """Detect contours and extract bounding rectangles."""
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        """Label connected regions and extract their bounding rectangles."""
+        height, width = mask.shape
         
-        rectangles = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            
-            # Filter out small areas
-            if w * h >= self.min_area:
-                # Apply padding
-                x = max(0, x - self.padding)
-                y = max(0, y - self.padding)
-                w = min(mask.shape[1] - x, w + 2 * self.padding)
-                h = min(mask.shape[0] - y, h + 2 * self.padding)
-                
-                rectangles.append((x, y, w, h))
+        # Detect on a max-pooled mask for large images, then scale rectangles back
+        scale = DOWNSAMPLE_FACTOR if max(mask.shape) > DOWNSAMPLE_MIN_SIZE else 1
+        
+        # Dilate by the padding at full resolution so nearby regions merge and boxes
+        # come out padded; the same kernel also max-pools each scale x scale block
+        size = 2 * self.padding + scale
+        if size > 1:
+            kernel = np.ones((size, size), np.uint8)
+            dilated = cv2.dilate(mask, kernel, anchor=(self.padding, self.padding))
+        else:
+            dilated = mask
+        
+        if scale > 1:
+            dilated = np.ascontiguousarray(dilated[::scale, ::scale])
+        
+        # Bounding boxes come straight from the label stats
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(dilated, connectivity=8, ltype=cv2.CV_32S)
         
-        return rectangles
+        # Count changed pixels per region, excluding the dilation halo
+        if scale > 1:
+            # Exact changed-pixel count of each scale x scale block, padding odd edges
+            changed = np.pad(mask > 0, ((0, -height % scale), (0, -width % scale)))
+            block_counts = changed.reshape(labels.shape[0], scale, labels.shape[1], scale).sum(axis=(1, 3))
+            areas = np.bincount(labels.ravel(), weights=block_counts.ravel(), minlength=n)
+        else:
+            areas = np.bincount(labels[mask > 0], minlength=n)
+        
+        # Filter out small areas (changed pixel count), skipping the background label
+        keep = areas[1:] >= self.min_area
+        boxes = stats[1:][keep, :4] * scale
+        
+        # Clamp scaled rectangles to the original image
+        xs, ys = boxes[:, 0], boxes[:, 1]
+        ws = np.minimum(boxes[:, 2], width - xs)
+        hs = np.minimum(boxes[:, 3], height - ys)
+        
+        return list(zip(xs.tolist(), ys.tolist(), ws.tolist(), hs.tolist()))
     
     def create_overlay(self, img_shape: Tuple[int, int], rectangles: List[Tuple[int, int, int, int]]) -> Image.Image:
         """Create transparent overlay with bounding rectangles."""
-        # Create transparent RGBA image
-        overlay = Image.new('RGBA', (img_shape[1], img_shape[0]), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
+        height, width = img_shape[:2]
         
-        # Draw semi-transparent red rectangles
+        # Accumulate every rectangle's fill and outline alpha first
+        fill_alpha = np.zeros((height, width), np.uint8)
+        outline_alpha = np.zeros((height, width), np.uint8)
         for x, y, w, h in rectangles:
-            # Rectangle outline
-            draw.rectangle([x, y, x + w, y + h], outline=(255, 0, 0, 255), width=2)
             # Semi-transparent fill
-            draw.rectangle([x, y, x + w, y + h], fill=(255, 0, 0, 64))
+            fill_alpha[y:y + h, x:x + w] = 64
+            # 2px rectangle outline drawn inside the box
+            outline_alpha[y:y + 2, x:x + w] = 255
+            outline_alpha[max(y, y + h - 2):y + h, x:x + w] = 255
+            outline_alpha[y:y + h, x:x + 2] = 255
+            outline_alpha[y:y + h, max(x, x + w - 2):x + w] = 255
         
-        return overlay
+        # Compose the red RGBA overlay in one pass; the outline wins over the fill
+        overlay = np.zeros((height, width, 4), np.uint8)
+        overlay[..., 0] = 255
+        np.maximum(outline_alpha, fill_alpha, out=overlay[..., 3])
+        
+        return Image.fromarray(overlay, 'RGBA')
     
-    def compare_images(self, img1_path: str, img2_path: str, output_dir: str = "output"):
+    def compare_images(self, img1_path: str, img2_path: str, output_dir: str = "output",
+                       in_memory: bool = False, write_json: bool = True):
         """
         Complete image comparison workflow.
         
+        Args:
+            in_memory: Return the overlay image under "overlay" instead of saving it
+            write_json: Save rectangle data as a JSON file next to the overlay
+        
         Returns:
             dict: Results containing paths and rectangle count
         """
-        # Create output directory
+        # Create output directory if anything is written to disk
         output_path = Path(output_dir)
-        output_path.mkdir(exist_ok=True)
+        if write_json or not in_memory:
+            output_path.mkdir(exist_ok=True)
         
         # Generate output filename prefix from input filenames
         img1_name = Path(img1_path).stem
@@ -118,46 +276,56 @@ class ShotDiff:
         # Load images
         img1, img2 = self.load_images(img1_path, img2_path)
         
-        # Generate difference map
-        diff_map = self.generate_diff_map(img1, img2)
-        
-        # Threshold differences
-        mask = self.threshold_differences(diff_map)
-        
-        # Detect contours and get bounding rectangles
-        rectangles = self.detect_contours(mask)
-        
-        # Create overlay
-        overlay = self.create_overlay(img1.shape, rectangles)
-        
-        # Save overlay
-        overlay_path = output_path / f"{prefix}_rectangles.png"
-        overlay.save(overlay_path)
-        
-        # Save rectangle data as JSON
-        json_path = output_path / f"{prefix}_rectangles.json"
-        rectangle_data = [{"x": x, "y": y, "w": w, "h": h} for x, y, w, h in rectangles]
-        with open(json_path, 'w') as f:
-            json.dump(rectangle_data, f, indent=2)
+        if np.array_equal(img1, img2):
+            # Identical images have no differences; skip the whole pipeline
+            rectangles = []
+            overlay = blank_overlay(img1.shape[0], img1.shape[1])
+        else:
+            # Threshold squared per-pixel differences
+            mask = self._compute_mask(img1, img2)
+            
+            # Detect contours and get bounding rectangles
+            rectangles = self.detect_contours(mask)
+            
+            # Create overlay
+            overlay = self.create_overlay(img1.shape, rectangles)
         
-        return {
-            "overlay_path": str(overlay_path),
-            "json_path": str(json_path),
+        results = {
             "rectangles_found": len(rectangles),
             "rectangles": rectangles
         }
+        
+        if write_json:
+            # Save rectangle data as compact JSON
+            json_path = output_path / f"{prefix}_rectangles.json"
+            rectangle_data = [{"x": x, "y": y, "w": w, "h": h} for x, y, w, h in rectangles]
+            with open(json_path, 'w') as f:
+                json.dump(rectangle_data, f, separators=(',', ':'))
+            results["json_path"] = str(json_path)
+        
+        if in_memory:
+            results["overlay"] = overlay
+        else:
+            # Save overlay
+            overlay_path = output_path / f"{prefix}_rectangles.png"
+            overlay.save(overlay_path)
+            results["overlay_path"] = str(overlay_path)
+        
+        return results
 
 
 def main():
     parser = argparse.ArgumentParser(description="Smart Screenshot Comparison Utility")
     parser.add_argument("img1", help="Path to first image")
     parser.add_argument("img2", help="Path to second image")
-    parser.add_argument("-t", "--threshold", type=int, default=50, 
-                       help="Pixel difference threshold (0-255), default: 50")
+    parser.add_argument("-t", "--threshold", type=float, default=50, 
+                       help="Pixel RGB distance threshold (0-441), default: 50")
     parser.add_argument("-m", "--min-area", type=int, default=100,
-                       help="Minimum rectangle area to keep, default: 100")
+                       help="Minimum changed pixels per region to keep, default: 100")
     parser.add_argument("-p", "--padding", type=int, default=5,
                        help="Rectangle padding in pixels, default: 5")
+    parser.add_argument("--cuda", action="store_true",
+                       help="Compute the diff on the GPU if OpenCV has CUDA support")
     parser.add_argument("-o", "--output", default="output",
                        help="Output directory, default: output")
     parser.add_argument("-v", "--verbose", action="store_true",
@@ -167,9 +335,10 @@ def main():
     
     # Create ShotDiff instance
     shot_diff = ShotDiff(
-        diff_threshold=args.threshold,
+        diff_threshold=squared_threshold(args.threshold),
         min_area=args.min_area,
-        padding=args.padding
+        padding=args.padding,
+        use_cuda=args.cuda
     )
     
     try: